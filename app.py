@@ -1,78 +1,81 @@
 import streamlit as st
-import fitz  # PyMuPDF
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import urllib.parse
-import tempfile
 import math
 import gc
 import shutil
-import uuid
+import time
+import random
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, Tuple, Dict, Any
 
-# --- [0. 核心配置与工具] ---
+from config import Config
+from pdf_worker import MP_CONTEXT, PDFProcessor, process_one_channel
 
-class Config:
-    """集中管理配置，显式区分环境变量与应用逻辑常数"""
-    SECRETS = {
-        "SYS_PASSWORD": os.getenv("SYS_PASSWORD", "admin888"),
-        "BAIDU_AK": os.getenv("BAIDU_AK", ""),
-        "BAIDU_SK": os.getenv("BAIDU_SK", ""),
-    }
-    
-    APP = {
-        "APP_FOLDER": os.getenv("APP_FOLDER", "PDF_Distributor"),
-        "FILE_PREFIX": os.getenv("FILE_PREFIX", "Dist"),
-        "TOKEN_FILE": "baidu_token.json",
-        "RASTER_DPI": 2.5,  # 栅格化倍数，过高会导致 OOM
-        "JPG_QUALITY": 80,
-        "TEMP_STAY_DIR": "output_cache", # 全局缓存根目录
-        "WM_CONFIG": {
-            "WIDTH_PCT": 0.6,    # 水印占页面宽度的比例
-            "HEIGHT_MULT": 2.5,  # 纵向间距倍数
-            "MARGIN_Y": 100,     # 上下安全边距
-        }
-    }
-
-    CHANNEL_DEFAULTS = {
-        "feishu": {
-            "opw": os.getenv("FEISHU_OPW", "zwg5427"), 
-            "upw": os.getenv("FEISHU_UPW", "888888"), 
-            "suffix": "f", "sub": "Feishu", "name": "飞书"
-        },
-        "wecom":  {
-            "opw": os.getenv("WECOM_OPW", "zwg5427"), 
-            "upw": os.getenv("WECOM_UPW", "888888"), 
-            "suffix": "w","sub": "WeCom",  "name": "企微"
-        },
-        "red":    {
-            "opw": os.getenv("RED_OPW", "zwg5427"), 
-            "upw": os.getenv("RED_UPW", "888888"), 
-            "suffix": "r", "sub": "Red",    "name": "小红书"
-        },
-    }
-
-    DEFAULT_WM_PATHS = {
-        'feishu': 'WM.Feishu.png',
-        'wecom': 'WM.WeCom.png',
-        'red': 'WM.Red.png'
-    }
+try:  # 可选依赖：orjson 为 C 扩展，序列化/解析更快；缺失时回退标准库
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(',', ':'))
+
+    json_loads = json.loads
 
 # --- [1. 业务逻辑层] ---
 
+class _JitterRetry(Retry):
+    """urllib3 重试策略：指数退避加全抖动，Retry-After 最长只等 32 秒"""
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, min(32, super().get_backoff_time()))
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(32, retry_after)
+
 class BaiduManager:
     def __init__(self, ak: str, sk: str, t_file: str):
         self.ak = ak
         self.sk = sk
         self.t_file = t_file
         self.api_base = "https://pan.baidu.com/rest/2.0/xpan"
-        self.headers = {'User-Agent': 'pan.baidu.com'}
+        self.headers = {'User-Agent': 'pan.baidu.com', 'Connection': 'keep-alive'}
+        self.timeout = (5, 30)  # (连接, 读取)
+        self.sess = self._build_session()
+        # 实例经 st.cache_resource 在所有会话线程间共享，token 的刷新与落盘需串行
+        self._token_lock = threading.RLock()
         self.token_data = self._load_token()
 
+    def _build_session(self) -> requests.Session:
+        """复用 TCP/TLS 连接，避免每次请求重新握手"""
+        sess = requests.Session()
+        sess.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=8,
+            max_retries=_JitterRetry(total=3, backoff_factor=1,
+                                     status_forcelist=[429, 500, 502, 503, 504],
+                                     allowed_methods=None,  # 上传相关 POST 也需重试
+                                     respect_retry_after_header=True,
+                                     raise_on_status=False)
+        )
+        sess.mount('https://', adapter)
+        # 授权接口由 refresh_token_logic 自行退避重试，不再叠加适配器重试
+        sess.mount('https://openapi.baidu.com', HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+        return sess
+
     def _load_token(self) -> Optional[Dict]:
         if os.path.exists(self.t_file):
             try:
@@ -83,12 +86,32 @@ class BaiduManager:
         return None
 
     def save_token(self, data: Dict):
-        with open(self.t_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f)
-        self.token_data = data
+        data['_iat'] = time.time()  # 记录签发时间，用于提前刷新
+        with self._token_lock:
+            with open(self.t_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            self.token_data = data
+
+    @staticmethod
+    def _backoff(attempt: int, resp: Optional[requests.Response] = None):
+        """指数退避 + 全抖动，避免多个会话同步重试；服务端给出 Retry-After 时以其为准"""
+        retry_after = resp.headers.get('Retry-After', '') if resp is not None else ''
+        if retry_after.isdigit():
+            time.sleep(min(32, int(retry_after)))  # 设上限，避免服务端长时间阻塞 UI 线程
+        else:
+            time.sleep(min(32, random.uniform(0, 2 ** attempt)))
 
     def refresh_token_logic(self) -> bool:
         """执行 Refresh Token 换取 Access Token """
+        stale = (self.token_data or {}).get('access_token')
+        with self._token_lock:
+            # 等锁期间其他会话可能已刷新成功，直接复用
+            if self.token_data and self.token_data.get('access_token') != stale:
+                return True
+            return self._refresh_token_locked()
+
+    def _refresh_token_locked(self) -> bool:
+        """刷新主体，需在持有 _token_lock 时调用 """
         if not self.token_data or 'refresh_token' not in self.token_data:
             return False
             
@@ -99,13 +122,20 @@ class BaiduManager:
             "client_id": self.ak,
             "client_secret": self.sk
         }
-        try:
-            res = requests.get(refresh_url, params=params, timeout=10).json()
-            if 'access_token' in res:
-                self.save_token(res)
-                return True
-        except Exception:
-            pass
+        for i in range(3):
+            resp = None
+            try:
+                resp = self.sess.get(refresh_url, params=params, timeout=self.timeout)
+                res = json_loads(resp.content)
+                if 'access_token' in res:
+                    self.save_token(res)
+                    return True
+                if res.get('error') == 'invalid_grant':  # refresh_token 已失效，重试无意义
+                    break
+            except Exception:
+                pass
+            if i < 2:
+                self._backoff(i, resp)
         return False
 
     def check_auth(self) -> bool:
@@ -113,10 +143,22 @@ class BaiduManager:
         if not self.token_data or 'access_token' not in self.token_data:
             return False
         
+        # 0. 已知签发时间：临近过期 (5 分钟内) 主动刷新，否则直接视为有效
+        iat = self.token_data.get('_iat')
+        if iat is not None:
+            if time.time() < iat + self.token_data.get('expires_in', 2592000) - 300:
+                st.session_state["refresh_retry_done"] = False
+                return True
+            # 与下方自动刷新共用标志位：刷新失败后不在每次 rerun 时反复重试
+            if not st.session_state.get("refresh_retry_done", False):
+                st.session_state["refresh_retry_done"] = True
+                if self.refresh_token_logic():
+                    return True
+
         # 1. 尝试探测现有 token 状态
         try:
             url = f"{self.api_base}/file?method=list&access_token={self.token_data.get('access_token')}&dir=/apps&limit=1"
-            res = requests.get(url, headers=self.headers, timeout=5).json()
+            res = json_loads(self.sess.get(url, timeout=self.timeout).content)
             if res.get('errno') == 0:
                 st.session_state["refresh_retry_done"] = False # 重置刷新标志位
                 return True
@@ -131,14 +173,21 @@ class BaiduManager:
         
         return False
 
-    def upload(self, local_path: str, app_folder: str, remote_sub: str) -> Tuple[str, str]:
-        """百度云三阶段分片上传逻辑 """
+    def _on_auth_errno(self, errno: Any):
+        """接口返回 token 失效 (110/111/-6) 时丢弃签发时间，下次 check_auth 回退到探测+刷新链路 """
+        if errno not in (110, 111, -6):
+            return
+        with self._token_lock:
+            if self.token_data and self.token_data.pop('_iat', None) is not None:
+                with open(self.t_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.token_data, f)
+
+    def upload_bytes(self, buf: bytes, filename: str, app_folder: str, remote_sub: str) -> Tuple[str, str]:
+        """百度云三阶段分片上传逻辑，直接上传内存中的文件内容 """
         try:
-            p = Path(local_path)
-            fn = p.name
-            file_bytes = p.read_bytes()
-            md5 = hashlib.md5(file_bytes).hexdigest()
-            fsize = len(file_bytes)
+            fn = filename
+            md5 = hashlib.md5(buf).hexdigest()
+            fsize = len(buf)
             
             target_dir = f"/apps/{app_folder}/{remote_sub}"
             tk = self.token_data['access_token']
@@ -147,112 +196,49 @@ class BaiduManager:
             pre_url = f"{self.api_base}/file?method=precreate&access_token={tk}"
             pre_data = {
                 'path': f"{target_dir}/{fn}", 'size': str(fsize), 'isdir': '0',
-                'autoinit': '1', 'block_list': json.dumps([md5]), 'rtype': '3'
+                'autoinit': '1', 'block_list': json_dumps([md5]), 'rtype': '3'
             }
-            pre = requests.post(pre_url, data=pre_data, headers=self.headers).json()
+            pre = json_loads(self.sess.post(pre_url, data=pre_data, timeout=self.timeout).content)
             
             if 'uploadid' not in pre:
+                self._on_auth_errno(pre.get('errno'))
                 return "FAILED", f"预处理失败: {pre.get('errno')}"
 
             # 2. 分片上传 (此处为小文件单片模式)
             up_url = (f"https://d.pcs.baidu.com/rest/2.0/pcs/superfile2?method=upload&access_token={tk}"
                       f"&type=tmpfile&path={urllib.parse.quote(f'{target_dir}/{fn}')}"
                       f"&uploadid={pre['uploadid']}&partseq=0")
-            requests.post(up_url, files={'file': file_bytes}, headers=self.headers)
+            # 直接以原始字节体上传，省去 multipart 封装
+            self.sess.post(up_url, data=buf, timeout=self.timeout,
+                           headers={'Content-Type': 'application/octet-stream'})
 
             # 3. 合并创建
             create_url = f"{self.api_base}/file?method=create&access_token={tk}"
             create_data = {
                 'path': f"{target_dir}/{fn}", 'size': str(fsize), 'isdir': '0',
-                'uploadid': pre['uploadid'], 'block_list': json.dumps([md5]), 'rtype': '3'
+                'uploadid': pre['uploadid'], 'block_list': json_dumps([md5]), 'rtype': '3'
             }
-            final = requests.post(create_url, data=create_data, headers=self.headers).json()
+            final = json_loads(self.sess.post(create_url, data=create_data, timeout=self.timeout).content)
             
             if 'fs_id' in final:
                 return "SUCCESS", f"{target_dir}/{fn}"
+            self._on_auth_errno(final.get('errno'))
             return "FAILED", f"落盘失败: {final.get('errno')}"
         except Exception as e:
             return "FAILED", str(e)
 
-class PDFProcessor:
-    @staticmethod
-    def create_task_dir() -> Path:
-        """创建隔离的任务目录，防止并发冲突 """
-        task_id = f"{datetime.now().strftime('%H%M%S')}_{uuid.uuid4().hex[:6]}"
-        task_path = Path(Config.APP["TEMP_STAY_DIR"]) / task_id
-        task_path.mkdir(parents=True, exist_ok=True)
-        return task_path
-
-    @staticmethod
-    def rasterize_pdf(input_path: Path, output_path: Path, password: str = None) -> bool:
-        """PDF 去矢量化，增加显式内存回收逻辑 """
-        try:
-            with fitz.open(input_path) as src:
-                if src.is_encrypted:
-                    if not (password and src.authenticate(password)):
-                        return False
-
-                with fitz.open() as r_doc:
-                    mat = fitz.Matrix(Config.APP["RASTER_DPI"], Config.APP["RASTER_DPI"])
-                    for page in src:
-                        pix = page.get_pixmap(matrix=mat)
-                        img_bytes = pix.tobytes("jpg", Config.APP["JPG_QUALITY"])
-                        
-                        np = r_doc.new_page(width=page.rect.width, height=page.rect.height)
-                        np.insert_image(np.rect, stream=img_bytes)
-                        
-                        # 内存即时释放 
-                        pix = None
-                        del img_bytes
-                        
-                    r_doc.save(output_path)
-            return True
-        except Exception as e:
-            st.error(f"栅格化错误: {e}")
-            return False
-        finally:
-            gc.collect() # 显式内存回收 
+# --- [2. UI 工具函数] ---
+@st.cache_resource(show_spinner=False)
+def get_manager(ak: str, sk: str, t_file: str) -> BaiduManager:
+    """跨 rerun 复用同一个 BaiduManager，保持连接池与 token 常驻内存 """
+    return BaiduManager(ak, sk, t_file)
 
-    @staticmethod
-    def add_watermark(target_pdf_path: Path, output_path: Path, wm_bytes: Optional[bytes], 
-                      owner_pw: str, user_pw: str):
-        if not os.path.exists(target_pdf_path): return
-        
-        # 显式打开文档
-        with fitz.open(target_pdf_path) as doc:
-            if wm_bytes:
-                with fitz.open("png", wm_bytes) as img_doc:
-                    img_rect = img_doc[0].rect
-                    iw, ih = img_rect.width, img_rect.height
-                    
-                    with fitz.open() as wm_pdf_doc:
-                        w_page = wm_pdf_doc.new_page(width=iw, height=ih)
-                        w_page.insert_image(img_rect, stream=wm_bytes)
-                        
-                        cfg = Config.APP["WM_CONFIG"]
-                        for page in doc:
-                            vw = page.rect.width * cfg["WIDTH_PCT"]
-                            vh = vw * (ih / iw)
-                            step_y = vh * cfg["HEIGHT_MULT"]
-                            y = cfg["MARGIN_Y"] + vh / 2
-                            
-                            while y <= page.rect.height - cfg["MARGIN_Y"] - vh / 2:
-                                r = fitz.Rect(
-                                    (page.rect.width - vw) / 2, y - vh / 2, 
-                                    (page.rect.width + vw) / 2, y + vh / 2
-                                )
-                                page.show_pdf_page(r, wm_pdf_doc, 0)
-                                y += step_y
-                        # wm_pdf_doc 在 with 结束时自动关闭，不需要手动 close
-                del wm_bytes
-            
-            # 保存加密文档
-            doc.save(output_path, encryption=fitz.PDF_ENCRYPT_AES_256, 
-                     owner_pw=owner_pw, user_pw=user_pw)
-            # 让 with 块自动管理生命周期
-        gc.collect()
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
+def get_raster_bytes(pdf_bytes: bytes, zoom: float, quality: int, pw: str) -> Optional[bytes]:
+    """栅格化结果缓存：输入字节与参数不变时直接复用，避免重复渲染
+    异常不会被缓存，因此只有密码错误 (None) 会命中缓存 """
+    return PDFProcessor.rasterize_pdf(pdf_bytes, pw, zoom, quality)
 
-# --- [2. UI 工具函数] ---
 def cleanup_housekeeper():
     """管家机制：自动清理 24 小时前的旧任务目录 """
     base_dir = Path(Config.APP["TEMP_STAY_DIR"])
@@ -302,7 +288,7 @@ def main():
         target_folder = c1.text_input("网盘文件夹", value=Config.APP["APP_FOLDER"])
         file_prefix = c2.text_input("输出文件前缀", value=Config.APP["FILE_PREFIX"])
 
-    mgr = BaiduManager(app_key, secret_key, Config.APP["TOKEN_FILE"])
+    mgr = get_manager(app_key, secret_key, Config.APP["TOKEN_FILE"])
 
     # --- 授权逻辑 UI ---
     if not mgr.check_auth():
@@ -313,7 +299,7 @@ def main():
         if st.button("激活授权"):
             url = f"https://openapi.baidu.com/oauth/2.0/token?grant_type=authorization_code&code={code}&client_id={app_key}&client_secret={secret_key}&redirect_uri=oob"
             try:
-                res = requests.get(url, timeout=10).json()
+                res = json_loads(mgr.sess.get(url, timeout=mgr.timeout).content)
                 if 'access_token' in res:
                     mgr.save_token(res)
                     st.success("授权成功！")
@@ -352,64 +338,92 @@ def main():
             st.warning("请至少激活一个渠道")
             st.stop()
 
-        status = st.status("正在启动任务隔离环境...", expanded=True)
-        # 创建本次任务唯一的子目录 
-        task_dir = PDFProcessor.create_task_dir()
+        status = st.status("正在启动任务...", expanded=True)
         st.session_state.process_results = [] 
 
         try:
-            with tempfile.TemporaryDirectory() as td:
-                input_path = Path(td) / "source.pdf"
-                input_path.write_bytes(main_pdf.read())
-                
-                status.write("🔨 正在压制 PDF (去矢量化)...")
-                raster_path = Path(td) / "raster_base.pdf"
-                
-                if not PDFProcessor.rasterize_pdf(input_path, raster_path, src_pdf_password):
-                    status.update(label="❌ 处理失败", state="error")
-                    st.error("无法读取源 PDF，请检查密码。")
-                    shutil.rmtree(task_dir) # 失败清理
-                    st.stop()
-
-                dt_str = datetime.now().strftime('%y%m%d')
-                wm_cache = {} # 初始化缓存
+            status.write("🔨 正在压制 PDF (去矢量化)...")
+            raster_bytes = get_raster_bytes(main_pdf.getvalue(), Config.APP["RASTER_DPI"],
+                                            Config.APP["JPG_QUALITY"], src_pdf_password)
+            
+            if raster_bytes is None:
+                status.update(label="❌ 处理失败", state="error")
+                st.error("无法读取源 PDF，请检查密码。")
+                st.stop()
+
+            dt_str = datetime.now().strftime('%y%m%d')
+            wm_cache = {} # 初始化缓存
+            
+            jobs = []
+            for ch in configured_channels:
+                wm_bytes = None
+                # 优先从缓存获取水印，减少磁盘 IO
+                if ch['use_def_wm']:
+                    def_path = Config.DEFAULT_WM_PATHS.get(ch['id'])
+                    if def_path:
+                        if def_path not in wm_cache:
+                            if os.path.exists(def_path):
+                                with open(def_path, 'rb') as f:
+                                    wm_cache[def_path] = f.read()
+                        wm_bytes = wm_cache.get(def_path)
+                elif ch['custom_wm_file']:
+                    wm_bytes = ch['custom_wm_file'].getvalue()
                 
-                for ch in configured_channels:
-                    ch_name = ch['meta']['name']
-                    status.write(f"🎨 正在生成渠道文件: {ch_name}")
-                    
-                    wm_bytes = None
-                    # 优先从缓存获取水印，减少磁盘 IO
-                    if ch['use_def_wm']:
-                        def_path = Config.DEFAULT_WM_PATHS.get(ch['id'])
-                        if def_path:
-                            if def_path not in wm_cache:
-                                if os.path.exists(def_path):
-                                    with open(def_path, 'rb') as f:
-                                        wm_cache[def_path] = f.read()
-                            wm_bytes = wm_cache.get(def_path)
-                    elif ch['custom_wm_file']:
-                        wm_bytes = ch['custom_wm_file'].getvalue()
-                    
-                    out_filename = f"{file_prefix}{ch['meta']['suffix']}{dt_str}(先存后看).pdf"
-                    save_path = task_dir / out_filename
-                    
-                    PDFProcessor.add_watermark(raster_path, save_path, wm_bytes, ch['opw'], ch['upw'])
+                out_filename = f"{file_prefix}{ch['meta']['suffix']}{dt_str}(先存后看).pdf"
+                jobs.append((ch, out_filename, wm_bytes))
+
+            # 各渠道相互独立，多进程并行加水印与加密 (MuPDF 非线程安全)
+            status.write(f"🎨 正在并行生成 {len(jobs)} 个渠道文件...")
+            done = {}
+            with MP_CONTEXT.Manager() as mp_mgr, \
+                    ProcessPoolExecutor(max_workers=len(jobs), mp_context=MP_CONTEXT) as pool:
+                progress_q = mp_mgr.Queue()
+                futures = {
+                    pool.submit(process_one_channel, raster_bytes, wm, ch['opw'], ch['upw'],
+                                ch['meta'].get('low_sec', False), ch['meta']['name'],
+                                progress_q): ch['id']
+                    for ch, _, wm in jobs
+                }
+                # 主线程约每 100ms 轮询一次进度队列，界面刷新不阻塞子进程
+                pending = set(futures)
+                while pending:
+                    try:
+                        evt = progress_q.get(timeout=0.1)
+                        status.write(evt[3])
+                    except queue.Empty:
+                        pass
+                    for fut in [f for f in pending if f.done()]:
+                        done[futures[fut]] = fut.result()
+                        pending.discard(fut)
+                while not progress_q.empty():
+                    status.write(progress_q.get_nowait()[3])
+
+            # 按渠道配置顺序登记结果
+            failed = []
+            for ch, out_filename, _ in jobs:
+                state, payload = done[ch['id']]
+                if state != "SUCCESS":
+                    failed.append((ch['meta']['name'], payload))
+                    continue
+                st.session_state.process_results.append({
+                    "name": ch['meta']['name'],
+                    "filename": out_filename,
+                    "data": payload,
+                    "sub": ch['meta']['sub'],
+                    "uploaded": False
+                })
                     
-                    st.session_state.process_results.append({
-                        "name": ch_name,
-                        "filename": out_filename,
-                        "local_path": str(save_path),
-                        "sub": ch['meta']['sub'],
-                        "uploaded": False
-                    })
-                        
+            if failed:
+                label = "❌ 处理失败" if len(failed) == len(jobs) else "⚠️ 部分渠道生成失败"
+                status.update(label=label, state="error")
+                for ch_name, err in failed:
+                    st.error(f"{ch_name} 生成失败: {err}")
+            else:
                 status.update(label="🎉 转换任务全部完成", state="complete")
                 st.balloons()
-                
+            
         except Exception as e:
             st.error(f"系统运行崩溃: {e}")
-            if task_dir.exists(): shutil.rmtree(task_dir)
         finally:
             gc.collect()
 
@@ -425,21 +439,19 @@ def main():
                 c1.caption(f"文件名: {res['filename']}")
                 
                 # 本地下载
-                if os.path.exists(res['local_path']):
-                    with open(res['local_path'], "rb") as f:
-                        c2.download_button(
-                            label="💾 本地下载",
-                            data=f,
-                            file_name=res['filename'],
-                            mime="application/pdf",
-                            key=f"dl_{i}"
-                        )
+                c2.download_button(
+                    label="💾 本地下载",
+                    data=res['data'],
+                    file_name=res['filename'],
+                    mime="application/pdf",
+                    key=f"dl_{i}"
+                )
                 
                 # 云端推送
                 if not res['uploaded']:
                     if c3.button("☁️ 推送网盘", key=f"up_btn_{i}"):
                         with st.spinner(f"正在上传..."):
-                            state, msg = mgr.upload(res['local_path'], target_folder, res['sub'])
+                            state, msg = mgr.upload_bytes(res['data'], res['filename'], target_folder, res['sub'])
                             if state == "SUCCESS":
                                 st.success(f"上传成功")
                                 st.session_state.process_results[i]['uploaded'] = True
@@ -0,0 +1,53 @@
+"""集中配置：环境变量与应用逻辑常数"""
+import os
+
+
+class Config:
+    """集中管理配置，显式区分环境变量与应用逻辑常数"""
+    SECRETS = {
+        "SYS_PASSWORD": os.getenv("SYS_PASSWORD", "admin888"),
+        "BAIDU_AK": os.getenv("BAIDU_AK", ""),
+        "BAIDU_SK": os.getenv("BAIDU_SK", ""),
+    }
+    
+    APP = {
+        "APP_FOLDER": os.getenv("APP_FOLDER", "PDF_Distributor"),
+        "FILE_PREFIX": os.getenv("FILE_PREFIX", "Dist"),
+        "TOKEN_FILE": "baidu_token.json",
+        "RASTER_DPI": 2.5,  # 栅格化倍数，过高会导致 OOM
+        "JPG_QUALITY": 80,
+        "RASTER_WORKERS": int(os.getenv("RASTER_WORKERS", "4")),  # 栅格化进程上限，每个进程同时持有整页像素
+        "TEMP_STAY_DIR": "output_cache", # 全局缓存根目录
+        "WM_CONFIG": {
+            "WIDTH_PCT": 0.6,    # 水印占页面宽度的比例
+            "HEIGHT_MULT": 2.5,  # 纵向间距倍数
+            "MARGIN_Y": 100,     # 上下安全边距
+        }
+    }
+
+    CHANNEL_DEFAULTS = {
+        "feishu": {
+            "opw": os.getenv("FEISHU_OPW", "zwg5427"), 
+            "upw": os.getenv("FEISHU_UPW", "888888"), 
+            "suffix": "f", "sub": "Feishu", "name": "飞书",
+            "low_sec": os.getenv("FEISHU_LOW_SEC", "0") == "1"  # 仅需象征性保护时降级为 RC4-128
+        },
+        "wecom":  {
+            "opw": os.getenv("WECOM_OPW", "zwg5427"), 
+            "upw": os.getenv("WECOM_UPW", "888888"), 
+            "suffix": "w","sub": "WeCom",  "name": "企微",
+            "low_sec": os.getenv("WECOM_LOW_SEC", "0") == "1"
+        },
+        "red":    {
+            "opw": os.getenv("RED_OPW", "zwg5427"), 
+            "upw": os.getenv("RED_UPW", "888888"), 
+            "suffix": "r", "sub": "Red",    "name": "小红书",
+            "low_sec": os.getenv("RED_LOW_SEC", "0") == "1"
+        },
+    }
+
+    DEFAULT_WM_PATHS = {
+        'feishu': 'WM.Feishu.png',
+        'wecom': 'WM.WeCom.png',
+        'red': 'WM.Red.png'
+    }
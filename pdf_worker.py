@@ -0,0 +1,220 @@
+"""PDF 处理层：栅格化与水印加密
+
+独立于 Streamlit 脚本的可导入模块。进程池按模块路径序列化这里的函数，
+不受 Streamlit 每次 rerun 替换 __main__ 的影响。"""
+import fitz  # PyMuPDF
+import os
+import io
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Tuple, List, Union
+
+from config import Config
+
+try:  # 可选依赖：Pillow 链接 libjpeg-turbo 时 JPG 编码走 SIMD；缺失时回退 MuPDF 内置编码
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# 进程池统一使用 forkserver (Windows 回退 spawn)，避免 fork 多线程的 Streamlit 服务进程；
+# forkserver 只预加载本模块，不重新执行 Streamlit 脚本
+if "forkserver" in multiprocessing.get_all_start_methods():
+    MP_CONTEXT = multiprocessing.get_context("forkserver")
+    MP_CONTEXT.set_forkserver_preload(["pdf_worker"])
+else:
+    MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class PDFProcessor:
+    @staticmethod
+    def rasterize_pdf(pdf_bytes: bytes, password: str = None,
+                      zoom: float = Config.APP["RASTER_DPI"],
+                      quality: int = Config.APP["JPG_QUALITY"]) -> Optional[bytes]:
+        """PDF 去矢量化，返回栅格化后的 PDF 字节；仅密码校验失败返回 None，其余异常直接抛出，增加显式内存回收逻辑 """
+        try:
+            with fitz.open("pdf", pdf_bytes) as src:
+                if src.is_encrypted:
+                    if not (password and src.authenticate(password)):
+                        return None
+
+                n_pages = src.page_count
+
+                # 页面渲染为 CPU 密集型，按可用核数 (受配置上限约束) 拆分页码交给子进程并行处理
+                n_workers = max(1, min(_available_cpus(), Config.APP["RASTER_WORKERS"], n_pages))
+                rendered = {}
+                if n_workers == 1:
+                    # 单页或单核无需进程池，直接在当前进程渲染
+                    for i, w, h, img_bytes in _raster_pages(list(range(n_pages)), zoom, quality, src):
+                        rendered[i] = (w, h, img_bytes)
+                else:
+                    chunks = [list(range(n_pages))[k::n_workers] for k in range(n_workers)]
+                    with ProcessPoolExecutor(max_workers=n_workers, mp_context=MP_CONTEXT,
+                                             initializer=_raster_worker_init,
+                                             initargs=(pdf_bytes, password)) as pool:
+                        futures = [pool.submit(_raster_pages, c, zoom, quality) for c in chunks if c]
+                        for fut in as_completed(futures):
+                            for i, w, h, img_bytes in fut.result():
+                                rendered[i] = (w, h, img_bytes)
+
+                with fitz.open() as r_doc:
+                    for i in range(n_pages):
+                        w, h, img_bytes = rendered.pop(i)
+                        if img_bytes is None:
+                            # 纯扫描页：原样复制图片流，无需重新渲染
+                            r_doc.insert_pdf(src, from_page=i, to_page=i, links=False, annots=False)
+                            continue
+                        np = r_doc.new_page(width=w, height=h)
+                        np.insert_image(np.rect, stream=img_bytes)
+                        del img_bytes # 内存即时释放
+
+                    return r_doc.tobytes()
+        finally:
+            gc.collect() # 显式内存回收 
+
+    @staticmethod
+    def add_watermark(raster_bytes: bytes, wm_bytes: Optional[bytes], owner_pw: str, user_pw: str,
+                      encryption: int = fitz.PDF_ENCRYPT_AES_256) -> bytes:
+        # 直接从内存中的栅格化结果打开，无需落盘再读取
+        with fitz.open("pdf", raster_bytes) as doc:
+            if wm_bytes:
+                with fitz.open("png", wm_bytes) as img_doc:
+                    img_rect = img_doc[0].rect
+                    iw, ih = img_rect.width, img_rect.height
+                
+                with fitz.open() as wm_pdf_doc:
+                    wm_pdf_doc.new_page(width=iw, height=ih).insert_image(img_rect, stream=wm_bytes)
+                
+                    cfg = Config.APP["WM_CONFIG"]
+                    # 跨页不变的参数提到循环外
+                    w_pct, h_mult, margin_y = cfg["WIDTH_PCT"], cfg["HEIGHT_MULT"], cfg["MARGIN_Y"]
+                    aspect = ih / iw
+                    for page in doc:
+                        # page.rect 每次访问都会进入 MuPDF，单页只取一次
+                        pw, ph = page.rect.width, page.rect.height
+                        vw = pw * w_pct
+                        vh = vw * aspect
+                        half_h = vh / 2
+                        step_y = vh * h_mult
+                        cx_l, cx_r = (pw - vw) / 2, (pw + vw) / 2
+                        y_end = ph - margin_y - half_h
+                        # 一次性生成全部平铺块的纵向中心，供批量指令构造使用
+                        y0 = margin_y + half_h
+                        n_tiles = int((y_end - y0 + 1e-6) // step_y) + 1 if y_end >= y0 else 0
+                        if not n_tiles:
+                            continue
+                        ys = [y0 + k * step_y for k in range(n_tiles)]
+                    
+                        # 首块经 show_pdf_page 注册水印 XObject，其余块仅追加平移 + Do 指令，一次写回
+                        # 原样复制的扫描页内容流可能改写 CTM 且不复原，先以 q/Q 包裹再叠加水印
+                        if not page.is_wrapped:
+                            page.wrap_contents()
+                        # 只看页面级 XObject (invoker == 0)，排除 fzFrm 内嵌的 fullpage 等子表单
+                        known = {x[1] for x in page.get_xobjects() if x[2] == 0}
+                        page.show_pdf_page(fitz.Rect(cx_l, ys[0] - half_h, cx_r, ys[0] + half_h), wm_pdf_doc, 0)
+                        fm = next((x[1] for x in page.get_xobjects() if x[2] == 0 and x[1] not in known), None)
+                        if fm is None:
+                            for y in ys[1:]:
+                                page.show_pdf_page(fitz.Rect(cx_l, y - half_h, cx_r, y + half_h), wm_pdf_doc, 0)
+                            continue
+                        # 栅格页无旋转；页面坐标 y 轴向下、PDF 坐标 y 轴向上，故平移量取 ys[0] - y
+                        cms = [(1, 0, 0, 1, 0, ys[0] - y) for y in ys[1:]]
+                        batch = "".join(f"q {a} {b} {c} {d} {e} {f:.3f} cm /{fm} Do Q\n"
+                                        for a, b, c, d, e, f in cms)
+                        if batch:
+                            c_xref = page.get_contents()[-1]
+                            doc.update_stream(c_xref, doc.xref_stream(c_xref) + b"\n" + batch.encode())
+                    # wm_pdf_doc 在 with 结束时自动关闭，不需要手动 close
+                del wm_bytes
+            
+            # 输出加密文档
+            # 图片已是 JPG，不再重复压缩；其余流压缩并清理冗余对象以减小上传体积
+            out = doc.tobytes(encryption=encryption,
+                              owner_pw=owner_pw, user_pw=user_pw,
+                              garbage=4, clean=True, deflate=True,
+                              deflate_images=False, deflate_fonts=True)
+            # 让 with 块自动管理生命周期
+        gc.collect()
+        return out
+
+def _available_cpus() -> int:
+    """当前进程可用的 CPU 数 (考虑 CPU 亲和性)，不支持的平台回退 os.cpu_count()"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+_RASTER_SRC = None  # 栅格化子进程内缓存的源文档
+
+def _raster_worker_init(pdf_bytes: bytes, password: Optional[str]):
+    """子进程初始化：每个进程只打开一次源 PDF"""
+    global _RASTER_SRC
+    _RASTER_SRC = fitz.open("pdf", pdf_bytes)
+    if _RASTER_SRC.is_encrypted and password:
+        _RASTER_SRC.authenticate(password)
+
+def _is_image_only_page(page: fitz.Page) -> bool:
+    """单张图片铺满整页 (>=98%) 且无文本的页面，栅格化前后内容一致"""
+    # 旋转或有偏移的页面仍走渲染，保证输出页与新建栅格页的坐标系一致 (水印批量平移依赖此前提)
+    mb = page.mediabox
+    if page.rotation or mb.x0 or mb.y0 or page.cropbox != mb:
+        return False
+    # 注释 (签名/印章/批注) 需渲染进图片，原样复制会丢失
+    if page.first_annot is not None:
+        return False
+    if page.get_text("text").strip():
+        return False
+    infos = page.get_image_info()
+    if len(infos) != 1:
+        return False
+    page_area = page.rect.get_area()
+    if page_area <= 0 or fitz.Rect(infos[0]["bbox"]).get_area() / page_area < 0.98:
+        return False
+    # 含矢量路径的页面仍需去矢量化
+    return not page.get_drawings()
+
+def _encode_jpeg(pix: fitz.Pixmap, quality: int) -> bytes:
+    """RGB 像素编码为 JPG，优先使用 Pillow (libjpeg-turbo)"""
+    if Image is None:
+        return pix.tobytes("jpg", quality)
+    img = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality, subsampling=2, optimize=False, progressive=False)
+    return buf.getvalue()
+
+def _raster_pages(indices: List[int], zoom: float, quality: int,
+                  src: Optional[fitz.Document] = None) -> List[Tuple[int, float, float, Optional[bytes]]]:
+    """渲染指定页码，返回 (页码, 宽, 高, JPG 字节)；纯图片页不渲染，字节为 None
+    未传入 src 时使用子进程初始化时缓存的源文档"""
+    src = src if src is not None else _RASTER_SRC
+    mat = fitz.Matrix(zoom, zoom)
+    out = []
+    for i in indices:
+        page = src[i]
+        if _is_image_only_page(page):
+            out.append((i, page.rect.width, page.rect.height, None))
+            continue
+        # 显式 RGB 且无 alpha：每像素 3 字节，JPG 编码前无需再剥离透明通道
+        pix = page.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csRGB)
+        out.append((i, page.rect.width, page.rect.height, _encode_jpeg(pix, quality)))
+        pix = None
+    return out
+
+def process_one_channel(raster_bytes: bytes, wm_bytes: Optional[bytes], owner_pw: str,
+                         user_pw: str, low_sec: bool = False, ch_name: str = "",
+                         progress_q=None) -> Tuple[str, Union[bytes, str]]:
+    """单渠道加水印+加密，置于模块顶层以便子进程序列化调用；成功时返回 PDF 字节
+    进度事件 ('progress', 渠道名, 步骤序号, 文案) 推入 progress_q，由主线程统一渲染"""
+    def report(step: int, msg: str):
+        if progress_q is not None:
+            progress_q.put(('progress', ch_name, step, msg))
+
+    encryption = fitz.PDF_ENCRYPT_RC4_128 if low_sec else fitz.PDF_ENCRYPT_AES_256
+    report(0, f"🎨 正在生成渠道文件: {ch_name}")
+    try:
+        pdf_bytes = PDFProcessor.add_watermark(raster_bytes, wm_bytes, owner_pw, user_pw, encryption)
+        report(1, f"✅ 渠道文件已生成: {ch_name}")
+        return "SUCCESS", pdf_bytes
+    except Exception as e:
+        report(1, f"❌ {ch_name} 生成失败: {e}")
+        return "FAILED", str(e)
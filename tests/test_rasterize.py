@@ -0,0 +1,39 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from pdf_worker import PDFProcessor  # noqa: E402
+
+
+def _scan_doc() -> fitz.Document:
+    """600x800 的单图白色扫描页"""
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 60, 80), 0)
+    pix.set_rect(pix.irect, (255, 255, 255))
+    doc = fitz.open()
+    page = doc.new_page(width=600, height=800)
+    page.insert_image(page.rect, stream=pix.tobytes("png"))
+    return doc
+
+
+def _add_annot(page: fitz.Page):
+    annot = page.add_rect_annot(fitz.Rect(100, 200, 300, 400))
+    annot.set_colors(stroke=(1, 0, 0), fill=(1, 0, 0))
+    annot.update()
+
+
+def _add_drawing(page: fitz.Page):
+    page.draw_rect(fitz.Rect(100, 200, 300, 400), color=(1, 0, 0), fill=(1, 0, 0))
+
+
+@pytest.mark.parametrize("markup", [_add_annot, _add_drawing])
+def test_marked_up_scan_page_is_rasterized(markup):
+    doc = _scan_doc()
+    markup(doc[0])
+    out = PDFProcessor.rasterize_pdf(doc.tobytes())
+    with fitz.open("pdf", out) as r_doc:
+        page = r_doc[0]
+        assert page.first_annot is None
+        assert not page.get_drawings()
+        r, g, b = page.get_pixmap().pixel(200, 300)
+    # 标注内容以像素形式保留 (JPG 有损，留出容差)
+    assert r > 200 and g < 80 and b < 80, (r, g, b)
@@ -0,0 +1,34 @@
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from pdf_worker import PDFProcessor  # noqa: E402
+
+
+def _solid_png(w: int, h: int, rgb) -> bytes:
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, w, h), 0)
+    pix.set_rect(pix.irect, rgb)
+    return pix.tobytes("png")
+
+
+def _scan_pdf(wrapped: bool) -> bytes:
+    """600x800 的单图扫描页；wrapped=False 时内容流改写 CTM 且无 q/Q"""
+    doc = fitz.open()
+    page = doc.new_page(width=600, height=800)
+    page.insert_image(page.rect, stream=_solid_png(60, 80, (255, 255, 255)))
+    if not wrapped:
+        name = page.get_images()[0][7]
+        doc.update_stream(page.get_contents()[0], f"600 0 0 800 0 0 cm /{name} Do".encode())
+    return doc.tobytes()
+
+
+@pytest.mark.parametrize("wrapped", [True, False])
+def test_watermark_tiles_visible_on_scan_page(wrapped):
+    out = PDFProcessor.add_watermark(_scan_pdf(wrapped), _solid_png(100, 20, (255, 0, 0)), "o", "u")
+    with fitz.open("pdf", out) as doc:
+        assert doc.authenticate("u")
+        pix = doc[0].get_pixmap()
+    # WIDTH_PCT=0.6 -> 水印宽 360、高 72；首块中心 y=136，步长 180
+    for y in (136, 316, 496):
+        r, g, b = pix.pixel(300, y)
+        assert r > 200 and g < 80 and b < 80, (y, (r, g, b))